@@ -4,14 +4,36 @@ import re
 import gspread
 import json
 import base64
+import hashlib
+import random
+import bisect
+import calendar
 import time
+import threading
+import types
+import unicodedata
+import weakref
+from contextlib import contextmanager
+from functools import lru_cache
+from dataclasses import dataclass, field, asdict
+from cachetools import LRUCache, TTLCache
+from concurrent.futures import ThreadPoolExecutor, wait
+import logging
 from google.oauth2.service_account import Credentials
+import httpx
+from urllib3.util.retry import Retry
 from flask import Flask, request
-from linebot import LineBotApi, WebhookHandler
-from linebot.exceptions import InvalidSignatureError
-from linebot.models import MessageEvent, TextMessage, TextSendMessage, FollowEvent
+from linebot.v3 import WebhookHandler
+from linebot.v3.messaging import ApiClient, Configuration, MessagingApi, PushMessageRequest, ReplyMessageRequest, TextMessage
+from linebot.v3.webhooks import MessageEvent, TextMessageContent, FollowEvent
+import openai
 from openai import OpenAI  # 使用 OpenAI SDK 兼容格式
-from datetime import datetime, timedelta
+from datetime import date, datetime
+from scoring import evaluate_development, finalize_scores
+
+# **設定日誌（除錯訊息使用 DEBUG 等級，正式環境預設 INFO 不會格式化；可用 LOG_LEVEL 環境變數調整）**
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger(__name__)
 
 # **初始化 Flask 與 API 相關變數**
 app = Flask(__name__)
@@ -19,63 +41,278 @@ LINE_ACCESS_TOKEN = os.getenv("LINE_ACCESS_TOKEN")
 LINE_SECRET = os.getenv("LINE_SECRET")
 DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")  # 環境變數名稱更改
 
-# **初始化 LINE Bot API**
-line_bot_api = LineBotApi(LINE_ACCESS_TOKEN)
+# **初始化 LINE Messaging API（SDK v3，底層 urllib3 連線池共用 keep-alive 連線，不必每次重新 TLS 握手）
+LINE_POOL_MAXSIZE = int(os.getenv("LINE_POOL_MAXSIZE", "50"))  # 需涵蓋同時送出回覆的執行緒數
+
+line_configuration = Configuration(access_token=LINE_ACCESS_TOKEN)
+line_configuration.connection_pool_maxsize = LINE_POOL_MAXSIZE
+line_configuration.retries = Retry(total=2, backoff_factor=0.1)
+line_bot_api = MessagingApi(ApiClient(line_configuration))
 handler = WebhookHandler(LINE_SECRET)
 
+# **Webhook 事件交由背景執行緒處理，/callback 驗證簽章後立即回應 LINE，不必等待 DeepSeek 判斷
+EVENT_POOL = ThreadPoolExecutor(max_workers=32, thread_name_prefix="line-event")
+
+# **LINE 回覆交由背景執行緒送出，處理函式更新狀態後即可返回，不必等待 HTTPS 往返
+REPLY_POOL = ThreadPoolExecutor(max_workers=16, thread_name_prefix="line-reply")
+
+# **篩檢結果寫回試算表同樣在背景進行，不影響回覆速度
+RECORD_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix="sheet-record")
+
+def log_background_error(future):
+    """記錄背景執行緒（回覆訊息、處理事件）中發生的錯誤"""
+    error = future.exception()
+    if error is not None:
+        logger.error("背景工作失敗：%s", error, exc_info=error)
+
+# reply token 有時效，使用者訊息送出超過此時間（毫秒）就視為逾時
+REPLY_TOKEN_MAX_AGE_MS = 25000
+
+def send_reply(event, messages):
+    """以背景執行緒一次回覆所有訊息（最多 5 則）；reply token 可能已逾時（例如 AI 回應過久）時改用 push_message，避免必定失敗的回覆"""
+    if time.time() * 1000 - event.timestamp > REPLY_TOKEN_MAX_AGE_MS:
+        request_body = PushMessageRequest(to=event.source.user_id, messages=messages)
+        future = REPLY_POOL.submit(line_bot_api.push_message, request_body)
+    else:
+        request_body = ReplyMessageRequest(reply_token=event.reply_token, messages=messages)
+        future = REPLY_POOL.submit(line_bot_api.reply_message, request_body)
+    future.add_done_callback(log_background_error)
+
+def reply_text(event, *texts):
+    """將一或多段文字組成訊息後回覆（最多 5 則）"""
+    send_reply(event, [TextMessage(text=text) for text in texts])
+
+def push_in_background(user_id, messages):
+    """以背景執行緒推播訊息，與後續的 AI 判斷同時進行；回傳 Future，需要時可等待推播完成"""
+    future = REPLY_POOL.submit(line_bot_api.push_message, PushMessageRequest(to=user_id, messages=messages))
+    future.add_done_callback(log_background_error)
+    return future
+
 # **初始化 DeepSeek API（使用 OpenAI SDK 兼容格式）**
+# 共用連線池：保留已建立的 TLS 連線，並限制同時連線數，超過時於連線池排隊
+DEEPSEEK_MAX_CONNECTIONS = int(os.getenv("DEEPSEEK_MAX_CONNECTIONS", "100"))
+DEEPSEEK_MAX_KEEPALIVE = int(os.getenv("DEEPSEEK_MAX_KEEPALIVE", "50"))
+
+# 使用 HTTP/2（需 h2 套件，已列於 requirements.txt），多個請求可共用同一條連線
+deepseek_http_client = httpx.Client(
+    http2=True,
+    limits=httpx.Limits(
+        max_connections=DEEPSEEK_MAX_CONNECTIONS,
+        max_keepalive_connections=DEEPSEEK_MAX_KEEPALIVE,
+        keepalive_expiry=90,
+    ),
+    timeout=httpx.Timeout(connect=5, read=30, write=5, pool=10),
+)
 client = OpenAI(
     api_key=DEEPSEEK_API_KEY,
-    base_url="https://api.deepseek.com"  # 設定 DeepSeek API 端點
+    base_url="https://api.deepseek.com",  # 設定 DeepSeek API 端點
+    http_client=deepseek_http_client,
+    max_retries=0,  # 重試由 chat_with_deepseek 處理（指數退避），避免 SDK 內建重試疊加
 )
 
 # **連接 Google Sheets API（代碼保持不變）**
 SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
+RECORD_WORKSHEET_NAME = os.getenv("RECORD_WORKSHEET_NAME", "篩檢紀錄")
 service_account_json_base64 = os.getenv("GOOGLE_SERVICE_ACCOUNT_JSON")
 if service_account_json_base64:
     service_account_info = json.loads(base64.b64decode(service_account_json_base64))
     creds = Credentials.from_service_account_info(service_account_info, scopes=SCOPES)
     gspread_client = gspread.authorize(creds)
     SPREADSHEET_ID = "1twgKpgWZIzzy7XoMg08jQfweJ2lP4S2LEcGGq-txMVk"
-    sheet = gspread_client.open_by_key(SPREADSHEET_ID).sheet1
-    print("成功連接 Google Sheets！")
+    spreadsheet = gspread_client.open_by_key(SPREADSHEET_ID)
+    sheet = spreadsheet.sheet1
+    logger.info("成功連接 Google Sheets！")
+    # 篩檢結果寫入另一個工作表（需事先建立），不存在時略過寫入
+    try:
+        record_sheet = spreadsheet.worksheet(RECORD_WORKSHEET_NAME)
+    except gspread.WorksheetNotFound:
+        record_sheet = None
+        logger.warning("找不到工作表「%s」，篩檢結果將不會寫回試算表", RECORD_WORKSHEET_NAME)
 else:
-    print("無法獲取 GOOGLE_SERVICE_ACCOUNT_JSON，請確認環境變數是否正確設定！")
+    sheet = None
+    record_sheet = None
+    logger.warning("無法獲取 GOOGLE_SERVICE_ACCOUNT_JSON，請確認環境變數是否正確設定！")
+
+# **限制同時送往 DeepSeek 的請求數，尖峰時於此排隊而非一次湧入 API**
+DEEPSEEK_CONCURRENCY = int(os.getenv("DEEPSEEK_CONCURRENCY", "8"))
+deepseek_semaphore = threading.BoundedSemaphore(DEEPSEEK_CONCURRENCY)
+
+# **DeepSeek 重試設定：指數退避加上隨機抖動，避免大量使用者同時重試又擠爆 API
+DEEPSEEK_BACKOFF_MAX = 8  # 單次等待上限（秒）
+
+def deepseek_error_message(e):
+    """依錯誤類型回傳給使用者的訊息"""
+    if isinstance(e, (openai.AuthenticationError, openai.PermissionDeniedError, openai.BadRequestError)):
+        logger.error("API 金鑰錯誤或授權問題")
+        return "系統暫時無法處理您的回應，請稍後再試。"
+    if isinstance(e, openai.APIConnectionError):  # 包含 APITimeoutError
+        logger.error("網路連線問題")
+        return "系統回應緩慢，請稍後再試。"
+    if isinstance(e, openai.RateLimitError):
+        logger.error("速率限制問題")
+        return "系統暫時繁忙，請稍後再試。"
+    if isinstance(e, ValueError):  # 回應空白、被截斷或格式不符
+        logger.error("回應內容無法使用")
+        return "系統處理您的回應時出現問題，請稍後再試。"
+    logger.error("其他 API 錯誤")
+    return "系統處理您的回應時出現問題，請稍後再試。"
+
+def is_retryable_error(e):
+    """429、5xx 與連線/逾時錯誤可重試；授權、參數錯誤等 4xx 重試也不會成功"""
+    if isinstance(e, openai.APIStatusError):
+        return e.status_code == 429 or e.status_code >= 500
+    return True
+
+DEEPSEEK_MODEL = "deepseek-chat"
+SYSTEM_PROMPT = "你是一個語言篩檢助手，負責回答家長的問題與記錄兒童的語言發展情況，請提供幫助。請使用繁體中文回答。"
+SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}  # 所有呼叫共用，請勿修改
+
+# **DeepSeek 回應快取：temperature 為 0 時相同輸入的回應相同，命中時不再呼叫 API（API 錯誤不快取）
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", "2048"))
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", "3600"))
+llm_cache = TTLCache(maxsize=LLM_CACHE_SIZE, ttl=LLM_CACHE_TTL)
+llm_cache_lock = threading.Lock()
+llm_cache_stats = {"hits": 0, "misses": 0}
+
+def llm_cache_key(prompt, options):
+    """以模型、系統提示、prompt 與呼叫參數計算快取鍵"""
+    raw = "\0".join((DEEPSEEK_MODEL, SYSTEM_PROMPT, prompt, json.dumps(options, sort_keys=True, ensure_ascii=False)))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
 
 # **與 DeepSeek 互動的函式**
-def chat_with_deepseek(prompt, retry_count=2):
+def chat_with_deepseek(prompt, retry_count=2, parse=None, **options):
+    """呼叫 DeepSeek；options 直接傳給 API（例如 max_tokens、temperature、stop）
+    parse 將回應內容轉換為呼叫端需要的結果（格式不符時拋出 ValueError），有 parse 時回傳轉換結果"""
+    cache_key = llm_cache_key(prompt, options) if options.get("temperature") == 0 else None
+    if cache_key is not None:
+        with llm_cache_lock:
+            cached = llm_cache.get(cache_key)
+            llm_cache_stats["hits" if cached is not None else "misses"] += 1
+        if cached is not None:
+            return cached
+
     for attempt in range(retry_count + 1):
         try:
-            response = client.chat.completions.create(
-                model="deepseek-chat",
-                messages=[
-                    {"role": "system", "content": "你是一個語言篩檢助手，負責回答家長的問題與記錄兒童的語言發展情況，請提供幫助。請使用繁體中文回答。"},
-                    {"role": "user", "content": prompt}
-                ]
-            )
-            return response.choices[0].message.content
+            with deepseek_semaphore:
+                response = client.chat.completions.create(
+                    model=DEEPSEEK_MODEL,
+                    messages=[SYSTEM_MESSAGE, {"role": "user", "content": prompt}],
+                    **options
+                )
+            choice = response.choices[0]
+            content = choice.message.content
+            # 空白或因 max_tokens 截斷的回應（JSON 模式偶爾回傳空白內容）與格式不符同樣視為失敗，重試後仍失敗則回傳錯誤訊息
+            if not content or choice.finish_reason == "length":
+                raise ValueError(f"回應內容不完整（finish_reason={choice.finish_reason}）")
+            result = parse(content) if parse is not None else content
+            # 只快取正常結束且呼叫端可使用的回應，錯誤的回應不會被重複使用
+            if cache_key is not None and choice.finish_reason == "stop":
+                with llm_cache_lock:
+                    llm_cache[cache_key] = result
+            return result
         except Exception as e:
-            error_type = type(e).__name__
-            print(f"DeepSeek API 錯誤 (嘗試 {attempt+1}/{retry_count+1}): {error_type} - {str(e)}")
-            
-            # 最後一次嘗試失敗時
-            if attempt == retry_count:
-                # 判斷錯誤類型
-                if "Unauthorized" in str(e) or "Invalid" in str(e):
-                    print("API 金鑰錯誤或授權問題")
-                    return "系統暫時無法處理您的回應，請稍後再試。"
-                elif "Timeout" in str(e) or "Connection" in str(e):
-                    print("網路連線問題")
-                    return "系統回應緩慢，請稍後再試。"
-                elif "Rate" in str(e) or "Too many" in str(e):
-                    print("速率限制問題")
-                    return "系統暫時繁忙，請稍後再試。"
-                else:
-                    print("其他 API 錯誤")
-                    return "系統處理您的回應時出現問題，請稍後再試。"
-            
-            # 非最後一次嘗試，等待後重試
-            time.sleep(1)  # 添加延遲再重試
+            logger.warning("DeepSeek API 錯誤 (嘗試 %d/%d): %s - %s", attempt + 1, retry_count + 1, type(e).__name__, e)
+
+            # 最後一次嘗試失敗，或錯誤重試也無法恢復時直接回傳錯誤訊息
+            if attempt == retry_count or not is_retryable_error(e):
+                return deepseek_error_message(e)
+
+            # 非最後一次嘗試，等待後重試（1、2、4…秒加上抖動）
+            time.sleep(min(DEEPSEEK_BACKOFF_MAX, 2 ** attempt) + random.random() * 0.5)
+
+# **明確的簡短回應直接判斷，不需經過 DeepSeek**
+# 以正規化後的整句回應完全比對（不做部分比對，「有時候會」這類需依通過標準判斷的回應仍交給 DeepSeek）
+POSITIVE_ANSWERS = frozenset({
+    "可以", "是", "會", "有", "對", "好", "行", "是的", "對的", "有的", "會的", "可以的",
+    "沒錯", "沒問題", "當然", "當然會", "當然可以", "都會", "都可以", "yes", "y", "ok",
+})
+NEGATIVE_ANSWERS = frozenset({
+    "不可以", "否", "不會", "沒有", "不對", "不行", "不能", "不是", "沒", "無", "還不會", "還沒", "還沒有",
+    "都不會", "從來沒有", "完全不會", "no", "n",
+})
+UNCLEAR_ANSWERS = frozenset({
+    "不清楚", "不懂", "不知道", "聽不懂", "看不懂", "不明白", "不太懂", "不確定", "不了解", "不瞭解",
+    "什麼意思", "啥意思", "題目看不懂",
+})
+ANSWER_LABELS = {
+    **{answer: "符合" for answer in POSITIVE_ANSWERS},
+    **{answer: "不符合" for answer in NEGATIVE_ANSWERS},
+    **{answer: "不清楚" for answer in UNCLEAR_ANSWERS},
+}
+
+# **判斷與提示合併為一次呼叫，以 JSON 回傳（提示約 30 字，限制輸出長度）；固定溫度，結果穩定也可使用回應快取
+# 單獨的提示呼叫只在規則直接判斷為「不清楚」時使用（只取決於題目，命中率高）
+JUDGE_OPTIONS = types.MappingProxyType({"max_tokens": 96, "temperature": 0, "response_format": {"type": "json_object"}})
+HINT_OPTIONS = types.MappingProxyType({"max_tokens": 64, "temperature": 0})
+
+# **判斷與提示使用的 prompt 範本（題目固定的部分在讀取試算表時就先組好，每次只接上使用者回應）
+JUDGE_PROMPT_TEMPLATE = """
+題目：{question}
+例子：{hint}
+通過標準：{pass_criteria}
+回應："""
+
+JUDGE_PROMPT_INSTRUCTIONS = """
+根據題目、回應判斷回應是否符合「通過標準」：
+1. 不清楚：回應表示對題目疑惑如不清楚，或回應仍不足以判斷符不符合。
+2. 符合：回應符合「通過標準」(不需字句相同)或明確肯定。
+3. 不符合：回應並非不清楚且未達「通過標準」或明確否定。
+以 JSON 回覆，格式為 {"verdict": "符合、不符合或不清楚", "hint": "提示"}，勿額外解釋。
+verdict 為「不清楚」時，hint 為根據題目與例子生成的30字內簡單提示；其他情況 hint 為空字串。
+"""
+
+HINT_PROMPT_TEMPLATE = """
+題目：{question}，例子：{hint}
+使用者回應模糊或不理解題目需提示，請根據題目與例子生成30字內的簡單提示。
+"""
+
+# **同一題的回應只差在標點、全半形或語助詞時視為相同回應，共用先前的判斷結果
+JUDGEMENT_LABELS = ("符合", "不符合", "不清楚")
+ANSWER_NOISE_RE = re.compile(r"[\W_]+")  # 空白與標點符號
+# 句尾語助詞；「吧」、「嘛」帶有猜測、不確定語氣（例如「會吧」、「不會吧」），不可去除
+ANSWER_PARTICLES_RE = re.compile(r"[啊阿呀喔哦噢欸耶啦呢囉唷]+$")
+answer_label_cache = LRUCache(maxsize=int(os.getenv("ANSWER_LABEL_CACHE_SIZE", "8192")))
+answer_label_cache_lock = threading.Lock()
+
+def normalize_answer(user_message):
+    """將回應正規化：全形轉半形、去除空白標點與句尾語助詞"""
+    answer = ANSWER_NOISE_RE.sub("", unicodedata.normalize("NFKC", user_message)).lower()
+    return ANSWER_PARTICLES_RE.sub("", answer) or answer
+
+def cached_judgement(question, answer):
+    """不需呼叫 DeepSeek 的判斷：明確的簡短回應，或同一題先前相同回應的判斷；都沒有時回傳 None
+    answer 為 normalize_answer 正規化後的回應"""
+    label = ANSWER_LABELS.get(answer)
+    if label is not None:
+        return label, ""
+
+    # 以（判斷 prompt, 正規化回應）查詢先前的判斷：不同題目不會共用結果，試算表修改題目或通過標準後也不會沿用舊的判斷
+    with answer_label_cache_lock:
+        return answer_label_cache.get((question["判斷prompt"], answer))
+
+def parse_judgement(content):
+    """解析判斷呼叫回傳的 JSON，回傳 (判斷, 提示)；格式不符或判斷不是三種結果之一時拋出 ValueError"""
+    data = json.loads(content)
+    if not isinstance(data, dict):
+        raise ValueError("判斷結果不是 JSON 物件")
+    verdict = str(data.get("verdict", "")).strip()
+    if verdict not in JUDGEMENT_LABELS:
+        raise ValueError(f"無法辨識的判斷：{verdict}")
+    return verdict, str(data.get("hint") or "").strip()
+
+def judge_answer(question, user_message, answer):
+    """由 DeepSeek 判斷使用者回應是否符合該題通過標準，回傳 (判斷, 提示)：判斷為「符合」、「不符合」或「不清楚」
+    （API 錯誤時為錯誤訊息），提示只在判斷為「不清楚」時才有內容；answer 為正規化後的回應（快取鍵）"""
+    cache_key = (question["判斷prompt"], answer)
+    # 直接串接字串，使用者回應中的大括號不會被當成格式欄位
+    prompt = question["判斷prompt"] + user_message + JUDGE_PROMPT_INSTRUCTIONS
+    result = chat_with_deepseek(prompt, parse=parse_judgement, **JUDGE_OPTIONS)
+    if isinstance(result, str):  # API 錯誤訊息
+        return result, ""
+
+    with answer_label_cache_lock:
+        answer_label_cache[cache_key] = result
+    return result
 
 # **Flask 路由（API 入口點）**
 @app.route("/", methods=["GET"])
@@ -89,127 +326,305 @@ def callback():
     signature = request.headers["X-Line-Signature"]
     body = request.get_data(as_text=True)
 
-    try:
-        handler.handle(body, signature)
-    except InvalidSignatureError:
+    if not handler.parser.signature_validator.validate(body, signature):
         return "Invalid signature", 400
 
+    future = EVENT_POOL.submit(handler.handle, body, signature)
+    future.add_done_callback(log_background_error)
     return "OK"
 
 @app.route("/test_sheets", methods=["GET"])
 def test_sheets():
-    """測試 Google Sheets API 讀取資料"""
-    try:
-        sheet_data = sheet.get_all_values()  # 讀取試算表的所有內容
-        formatted_data = "\n".join([", ".join(row) for row in sheet_data])  # 轉換為可讀的字串格式
-        return f"成功讀取試算表內容：\n{formatted_data}"
-    except Exception as e:
-        return f"無法讀取 Google Sheets，錯誤訊息：{e}"
+    """測試 Google Sheets API 讀取資料（回傳記憶體中最近一次讀取的內容，不另外呼叫 API）"""
+    refresh_question_index()
+    if not sheet_rows:
+        return "無法讀取 Google Sheets，請查看伺服器紀錄"
+    formatted_data = "\n".join([", ".join(row) for row in sheet_rows])  # 轉換為可讀的字串格式
+    return f"成功讀取試算表內容：\n{formatted_data}"
     
+@app.route("/admin/reload", methods=["POST"])
+def admin_reload():
+    """立即重新讀取 Google Sheets 題目（需於 X-Admin-Token 標頭帶入 ADMIN_TOKEN）"""
+    admin_token = os.getenv("ADMIN_TOKEN")
+    if not admin_token or request.headers.get("X-Admin-Token") != admin_token:
+        return "Forbidden", 403
+
+    with questions_lock:
+        if not load_question_ranges():
+            return "無法讀取 Google Sheets", 500
+    return "已重新讀取題目"
+
+@app.route("/admin/cache_stats", methods=["GET"])
+def admin_cache_stats():
+    """回傳 DeepSeek 回應快取的命中統計（需於 X-Admin-Token 標頭帶入 ADMIN_TOKEN）"""
+    admin_token = os.getenv("ADMIN_TOKEN")
+    if not admin_token or request.headers.get("X-Admin-Token") != admin_token:
+        return "Forbidden", 403
+
+    with llm_cache_lock:
+        return {**llm_cache_stats, "size": len(llm_cache)}
+
 #獲取當前日期
-def get_formatted_today():
-    return datetime.now().strftime("%Y-%m-%d")
+def get_formatted_today(now=None):
+    """回傳 YYYY-MM-DD 格式的日期；now 為同一請求中已取得的日期時間（預設為現在）"""
+    return (now or datetime.now()).strftime("%Y-%m-%d")
 
 # **計算年齡函式（用於判斷兒童月齡）**
-def calculate_age(birthdate_str):
-    """計算孩子的實足月齡（滿 30 天進位一個月）"""
-    try:
-        birthdate = datetime.strptime(birthdate_str, "%Y-%m-%d").date()
-        today = datetime.today().date()
+BIRTHDATE_RE = re.compile(r"\b(\d{4})-(\d{2})-(\d{2})\b")  # 西元出生年月日 YYYY-MM-DD
 
-        years = today.year - birthdate.year
-        months = today.month - birthdate.month
-        days = today.day - birthdate.day
+@lru_cache(maxsize=4096)
+def months_between(birthdate, today):
+    """計算孩子到 today 的實足月齡（滿 30 天進位一個月）；只用整數運算，相同的出生日與日期直接重用結果"""
+    months = (today.year - birthdate.year) * 12 + today.month - birthdate.month
+    days = today.day - birthdate.day
 
-        if days < 0:
-            months -= 1
-            last_month_end = today.replace(day=1) - timedelta(days=1)
-            days += last_month_end.day
+    if days < 0:
+        # 向上個月借天數
+        months -= 1
+        prev_year, prev_month = (today.year, today.month - 1) if today.month > 1 else (today.year - 1, 12)
+        days += calendar.monthrange(prev_year, prev_month)[1]
 
-        if months < 0:
-            years -= 1
-            months += 12
+    if days >= 30:
+        months += 1
 
-        total_months = years * 12 + months
-        if days >= 30:
-            total_months += 1
+    return months
 
-        return total_months
+def parse_birthdate(match):
+    """由 BIRTHDATE_RE 的比對結果建立日期，日期不存在（例如 2020-13-45）時回傳 None"""
+    try:
+        return date(int(match.group(1)), int(match.group(2)), int(match.group(3)))
     except ValueError:
         return None
 
-# **讀取 Google Sheets 並篩選符合年齡的題目
-def get_questions_by_age(months):
-    """從 Google Sheets 讀取符合年齡的篩檢題目"""
+# **月齡 -> 題目對照表（讀取試算表時建立，questions_by_month[m] 即為 m 個月大適用的題目；超過 SHEET_CACHE_TTL 秒後重新讀取）
+SHEET_CACHE_TTL = int(os.getenv("SHEET_CACHE_TTL", "300"))
+SHEET_STALE_AFTER = 2 * SHEET_CACHE_TTL  # 平時由背景執行緒更新；超過此時間仍未更新（例如讀取失敗）才於請求中重新讀取
+AGE_RANGE_RE = re.compile(r"\d+")  # 解析年齡區間中的數字
+questions_by_month = ()  # 整個對照表一次替換，其他執行緒不會讀到一半更新的資料
+questions_by_group = {}  # 組別 -> 該組題目（tuple），與 questions_by_month 同時建立、整個替換
+questions_by_number = {}  # 題號 -> 題目（篩檢中依狀態記錄的題號取得題目）
+questions_loaded_at = 0.0  # 上次成功讀取的時間（time.monotonic）
+questions_lock = threading.Lock()  # 同一時間只讓一個執行緒重新讀取試算表
+sheet_rows = ()  # 最近一次讀取的試算表原始內容（/test_sheets 使用）
+
+def load_question_ranges():
+    """從 Google Sheets 讀取所有題目並建立月齡對照表"""
+    global questions_by_month, questions_by_group, questions_by_number, questions_loaded_at, sheet_rows
     try:
         sheet_data = sheet.get_all_values()  # 讀取試算表
-        questions = []  # 存放符合條件的題目
+        ranges = []
 
         for row in sheet_data[1:]:  # 跳過標題列
             age_range = row[1]  # 年齡區間（例如 "0-4個月"）
-            group_number = int(row[0])  # 組別欄
-            question_number = row[2]  # 題號（第三欄）
-            question_text = row[3]  # 題目內容（第四欄）
-            question_type = row[4]  # 題目類別R/E (第五欄)
-            hint = row[5]  # 提示 (第六欄)
-            pass_criteria = row[6]  # 通過標準 (第七欄)
 
             # **解析 "X-Y個月" 這種類型**
-            match = re.findall(r'\d+', age_range)
+            match = AGE_RANGE_RE.findall(age_range)
             if len(match) == 2:  # 只考慮 "X-Y個月" 這種類型
                 min_age, max_age = map(int, match)
-                if min_age <= months <= max_age:
-                    questions.append({"組別": group_number, "題號": question_number, "題目": question_text, "類別": question_type, "提示": hint, "通過標準": pass_criteria})
-
-        return questions if questions else None
+                question = types.MappingProxyType({  # 唯讀，供所有使用者共用
+                    "組別": int(row[0]),  # 組別欄
+                    "題號": int(row[2]),  # 題號（第三欄，轉為整數以便排序）
+                    "題目": row[3],  # 題目內容（第四欄）
+                    "類別": row[4],  # 題目類別R/E (第五欄)
+                    "提示": row[5],  # 提示 (第六欄)
+                    "通過標準": row[6],  # 通過標準 (第七欄)
+                    # 預先組好的 prompt（判斷時只需接上使用者回應）
+                    "判斷prompt": JUDGE_PROMPT_TEMPLATE.format_map({"question": row[3], "hint": row[5], "pass_criteria": row[6]}),
+                    "提示prompt": HINT_PROMPT_TEMPLATE.format_map({"question": row[3], "hint": row[5]}),
+                })
+                ranges.append((min_age, max_age, question))
+
+        by_month = [[] for _ in range(max((max_age for _, max_age, _ in ranges), default=-1) + 1)]
+        for min_age, max_age, question in ranges:  # 依試算表順序加入，維持題目順序
+            for month in range(min_age, max_age + 1):
+                by_month[month].append(question)
+        by_group = {}
+        for _, _, question in ranges:
+            by_group.setdefault(question["組別"], []).append(question)
+
+        questions_by_month = tuple(tuple(questions) for questions in by_month)
+        questions_by_group = {group: tuple(questions) for group, questions in by_group.items()}
+        questions_by_number = {question["題號"]: question for _, _, question in ranges}
+        sheet_rows = tuple(tuple(row) for row in sheet_data)
+        questions_loaded_at = time.monotonic()
+        return True
     except Exception as e:
-        print("讀取 Google Sheets 失敗，錯誤訊息：", e)
-        return None
+        logger.error("讀取 Google Sheets 失敗，錯誤訊息：%s", e)
+        return False
+
+def refresh_question_index():
+    """題目對照表不存在，或背景執行緒已超過 SHEET_STALE_AFTER 秒未能更新時重新讀取；其他執行緒正在讀取時沿用舊資料"""
+    if questions_by_month and time.monotonic() - questions_loaded_at < SHEET_STALE_AFTER:
+        return
+    if questions_lock.acquire(blocking=not questions_by_month):  # 尚無資料時需等待讀取完成
+        try:
+            if not questions_by_month or time.monotonic() - questions_loaded_at >= SHEET_STALE_AFTER:
+                load_question_ranges()  # 讀取失敗時沿用舊的題目
+        finally:
+            questions_lock.release()
 
-#  根據組別與總分判斷結果
-def evaluate_development(score_all_final, original_group):
-    standards = {
-        1: [2, 4, 7, 8, 9],
-        2: [8, 9, 9, 11, 13],
-        3: [11, 13, 14, 18, 19],
-        4: [17, 19, 21, 25, 28],
-        5: [22, 24, 25, 33, 38],
-        6: [25, 30, 31, 42, 45],
-        7: [33, 36, 44, 48, 50],
-        8: [37, 43, 48, 50, 50],
-        9: [44, 48, 50, 50, 50]
-    }
-    threshold = standards[original_group]
-
-    if score_all_final < threshold[0]:  # <5%
-        return "疑似遲緩"
-    elif score_all_final < threshold[1]:  # 5-25%
-        return "可能落後"
-    elif score_all_final >= threshold[1] and score_all_final < threshold[3]:
-        return "平均水準"
-    elif score_all_final < threshold[4]:  # 75-90%
-        return "稍微超前"
-    else:  # >90%
-        return "超前"
-
-def get_min_age_for_group(group): # 記住每組最小年齡
-    group_age_mapping = {1: 0, 2: 5, 3: 9, 4: 13, 5: 17, 6: 21, 7: 25, 8: 29, 9: 33}
-    return group_age_mapping.get(group, None)  # 若組別無效，回傳 None
-
-def get_group_all_score(group): # 記住每組別與其之前組別總分
-    group_all_score_mapping = {1: 5, 2: 10, 3: 15, 4: 20, 5: 26, 6: 32, 7: 38, 8: 44, 9: 50}
-    return group_all_score_mapping.get(group, None)
-
-def get_group_r_score(group): # 記住每組別與其之前組別R總分
-    group_r_score_mapping = {1: 3, 2: 6, 3: 9, 4: 12, 5: 16, 6: 18, 7: 21, 8: 23, 9: 24}
-    return group_r_score_mapping.get(group, None)
-
-def get_group_e_score(group): # 記住每組別與其之前組別E總分
-    group_e_score_mapping = {1: 2, 2: 5, 3: 9, 4: 13, 5: 16, 6: 21, 7: 27, 8: 33, 9: 39}
-    return group_e_score_mapping.get(group, None)
+# **依月齡取得符合年齡的題目
+def get_questions_by_age(months):
+    """從月齡對照表取出符合年齡的篩檢題目（唯讀 tuple，請勿修改）"""
+    refresh_question_index()
+    by_month = questions_by_month
+    if 0 <= months < len(by_month):
+        return by_month[months] or None
+    return None
+
+def get_questions_for_group(group): # 依組別直接查表取得該組題目
+    refresh_question_index()
+    return questions_by_group.get(group)
+
+def get_question(number): # 依題號取得題目，題目已從試算表刪除時回傳 None
+    refresh_question_index()
+    return questions_by_number.get(number)
+
+def refresh_sheet_periodically():
+    """背景執行緒：每 SHEET_CACHE_TTL 秒重新讀取試算表，使用者請求不需等待讀取"""
+    while True:
+        time.sleep(SHEET_CACHE_TTL)
+        with questions_lock:
+            load_question_ranges()
+
+load_question_ranges()
+threading.Thread(target=refresh_sheet_periodically, name="sheet-refresh", daemon=True).start()
 
 # **追蹤使用者狀態（模式），這裡用字典模擬（正式可用資料庫）
-user_states = {}
+# 依 user_id 雜湊分成多個分片，每個分片各有一把鎖，不同使用者之間不會互相等待
+STATE_SHARD_COUNT = 32  # 需為 2 的次方
+STATE_TTL_SECONDS = int(os.getenv("STATE_TTL_SECONDS", "3600"))  # Redis 中使用者狀態的保存時間（秒）
+STATE_LOCK_TIMEOUT = 30  # 秒；Redis 使用者鎖的期限，處理期間每 1/3 期限延長一次，worker 異常結束時逾時自動釋放
+
+class ShardedStateStore:
+    """以分片字典保存使用者狀態，讀寫時只鎖住該使用者所在的分片"""
+
+    def __init__(self, shard_count=STATE_SHARD_COUNT):
+        self.shards = [({}, threading.Lock()) for _ in range(shard_count)]
+        self.mask = shard_count - 1
+        self.user_locks = weakref.WeakValueDictionary()  # 只保留處理中使用者的鎖
+        self.user_locks_lock = threading.Lock()
+
+    def _shard(self, user_id):
+        return self.shards[hash(user_id) & self.mask]
+
+    def get(self, user_id):
+        states, lock = self._shard(user_id)
+        with lock:
+            return states.get(user_id)
+
+    def __setitem__(self, user_id, state):
+        states, lock = self._shard(user_id)
+        with lock:
+            states[user_id] = state
+
+    def pop(self, user_id, default=None):
+        """移除使用者狀態（回到主選單時不再佔用記憶體）"""
+        states, lock = self._shard(user_id)
+        with lock:
+            return states.pop(user_id, default)
+
+    @contextmanager
+    def try_lock(self, user_id):
+        """嘗試取得該使用者的鎖（不等待），yield 是否取得；取得時於處理訊息期間持有"""
+        with self.user_locks_lock:
+            lock = self.user_locks.get(user_id)
+            if lock is None:
+                lock = self.user_locks[user_id] = threading.Lock()
+        acquired = lock.acquire(blocking=False)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                lock.release()
+
+class RedisStateStore:
+    """以 Redis 保存使用者狀態（JSON），多個 worker 可共用同一份狀態；閒置超過 TTL 自動清除"""
+
+    def __init__(self, redis_url, ttl=STATE_TTL_SECONDS):
+        import redis  # 僅在設定 REDIS_URL 時才需要安裝
+        self.client = redis.Redis(connection_pool=redis.ConnectionPool.from_url(redis_url, max_connections=64))
+        self.ttl = ttl
+
+    def _key(self, user_id):
+        return f"st:{user_id}"
+
+    def _dumps(self, state):
+        # 緊湊格式、中文不轉義：字串較短，Redis 傳輸與儲存量較小
+        return json.dumps(asdict(state), ensure_ascii=False, separators=(",", ":"))
+
+    def _loads(self, data):
+        """還原狀態；舊格式或損毀的資料視為沒有狀態"""
+        if data is None:
+            return None
+        try:
+            return UserState(**json.loads(data))
+        except (TypeError, ValueError):
+            return None
+
+    def get(self, user_id):
+        """讀取狀態並同時延長 TTL（同一次往返），作答中的使用者不會因閒置計時而過期"""
+        key = self._key(user_id)
+        data, _ = self.client.pipeline(transaction=False).get(key).expire(key, self.ttl).execute()
+        return self._loads(data)
+
+    def __setitem__(self, user_id, state):
+        self.client.setex(self._key(user_id), self.ttl, self._dumps(state))
+
+    def pop(self, user_id, default=None):
+        """刪除使用者狀態並回傳刪除前的狀態（GET 與 DEL 同一次往返）"""
+        key = self._key(user_id)
+        data, _ = self.client.pipeline(transaction=True).get(key).delete(key).execute()
+        state = self._loads(data)
+        return default if state is None else state
+
+    @contextmanager
+    def try_lock(self, user_id):
+        """嘗試取得跨 worker 的使用者鎖（不等待），yield 是否取得；處理期間由背景執行緒定期延長期限，處理再久也不會中途失效"""
+        lock = self.client.lock(f"lk:{user_id}", timeout=STATE_LOCK_TIMEOUT)
+        if not lock.acquire(blocking=False):
+            yield False
+            return
+
+        stop = threading.Event()
+
+        def keep_alive():
+            while not stop.wait(STATE_LOCK_TIMEOUT / 3):
+                try:
+                    lock.reacquire()
+                except Exception as e:
+                    logger.warning("延長使用者鎖失敗：%s", e)
+
+        keeper = threading.Thread(target=keep_alive, name="state-lock-keeper", daemon=True)
+        keeper.start()
+        try:
+            yield True
+        finally:
+            stop.set()
+            keeper.join()  # 確認不會在釋放後才延長
+            lock.release()
+
+# 設定 REDIS_URL 時使用 Redis（可執行多個 worker），否則使用行程內的分片字典
+REDIS_URL = os.getenv("REDIS_URL")
+user_states = RedisStateStore(REDIS_URL) if REDIS_URL else ShardedStateStore()
+
+# **事件去重：LINE 未收到回應時會重送同一事件（相同 webhookEventId），已處理過的事件直接略過
+EVENT_DEDUP_TTL = 600  # 秒
+seen_events = TTLCache(maxsize=10000, ttl=EVENT_DEDUP_TTL)
+seen_events_lock = threading.Lock()
+
+def is_duplicate_event(event):
+    """回傳事件是否已處理過；第一次看到的事件會被記錄下來"""
+    event_id = getattr(event, "webhook_event_id", None)
+    if not event_id:
+        return False
+    if REDIS_URL:  # 多個 worker 共用同一份紀錄
+        return not user_states.client.set(f"ev:{event_id}", 1, nx=True, ex=EVENT_DEDUP_TTL)
+    with seen_events_lock:
+        if event_id in seen_events:
+            return True
+        seen_events[event_id] = True
+        return False
 
 # **定義不同模式
 MODE_MAIN_MENU = "主選單"
@@ -219,610 +634,329 @@ MODE_TREATMENT = "語言治療資訊模式"
 MODE_TESTING_FIRST = "首組篩檢"
 MODE_TESTING_FORWARD = "順向施測"
 MODE_TESTING_BACKWARD = "逆向施測"
+TESTING_MODES = (MODE_TESTING_FIRST, MODE_TESTING_FORWARD, MODE_TESTING_BACKWARD)
+
+# **使用者狀態（slots 減少每位使用者的記憶體用量，欄位存取也比字典查詢快）
+@dataclass(slots=True)
+class UserState:
+    mode: str = MODE_MAIN_MENU
+    total_months: int = 0
+    original_group: int = 0  # 首組組別
+    group: int = 0  # 目前施測的組別
+    current_index: int = 0
+    scores: dict = field(default_factory=dict)  # 累計總分、當前題組分數、R/E 分數
+    question_numbers: list = field(default_factory=list)  # 目前題組的題號（進入題組時記錄，作答期間試算表更新也不會換成別的題目）
+    right_questions: list = field(default_factory=list)  # 對題題號（已排序）
+    wrong_questions: list = field(default_factory=list)  # 錯題題號（已排序）
+
+# 沒有保存狀態的使用者即位於主選單；此物件不會被修改（只有篩檢中的狀態會在作答時更新），所有使用者共用
+MAIN_MENU_STATE = UserState()
+
+# **篩檢注意事項與題目訊息範本
+SCREENING_NOTICE_TEMPLATE = """您的孩子目前 {total_months} 個月大，請詳閱以下篩檢注意事項。
+
+1.您可以使用「可以」、「不可以」回應，也能描述孩子狀況交由AI判斷。如：
+題目：「當您對孩子說『不行』時，他會停下來嗎？」
+回應示範：「他會看著我，但停不停下來要看他心情。」
+
+2.若您不確定題目意思時，請回覆「不清楚」，AI會提供說明。
 
-@handler.add(MessageEvent, message=TextMessage)
+3.由於AI需要時間回應，請回答完後稍加等待並避免再次傳送訊息。
+
+4.請盡量完成所有題目，如需中斷請輸入「返回」。
+
+5.本測驗僅供參考，不代表正式診斷結果，如有疑慮請諮詢語言治療師。"""
+
+QUESTION_TEMPLATE = "題目：{question}\n\n輸入「返回」可中途退出篩檢。"
+
+# **篩檢結果訊息範本
+RESULT_TEMPLATE = """篩檢結束，總分為{score_all_final}分。
+評估結果為：{evaluate_result}。
+
+請記住，本測驗結果僅供參考，不代表真實診斷結果，若有疑慮請聯絡語言治療師。
+
+輸入「返回」回到主選單。"""
+
+REPORT_TEMPLATE = """若有需要請將此訊息給語言治療師看：
+本次篩檢時間為：{today}。
+該孩子於此篩檢時月齡為：{total_months}。
+正確題目為：{right_questions}。
+錯誤題目為：{wrong_questions}。"""
+
+@lru_cache(maxsize=1024)
+def build_result_text(score_all_final, original_group):
+    """組成篩檢結果訊息（只取決於總分與首組組別，相同組合直接重用快取的文字）"""
+    return RESULT_TEMPLATE.format(score_all_final=score_all_final, evaluate_result=evaluate_development(score_all_final, original_group))
+
+# **篩檢作答的基本檢查（空白、過長或只有符號/表情的回覆不送交 DeepSeek）
+MAX_ANSWER_LENGTH = 80
+INVALID_ANSWER_TEXT = f"請以{MAX_ANSWER_LENGTH}字內簡短描述孩子的狀況，例如「可以」、「不可以」；若不清楚題目意思請回覆「不清楚」。\n\n輸入「返回」可中途退出篩檢。"
+MISSING_QUESTIONS_TEXT = "找不到新題組，系統出現錯誤。返回主選單。"
+
+# **固定內容的訊息物件只建立一次，各使用者共用
+INVALID_ANSWER_MESSAGE = TextMessage(text=INVALID_ANSWER_TEXT)
+WAIT_MESSAGE = TextMessage(text="已收到回覆，請等待AI回應，等待過程中請勿再發送訊息。")
+BUSY_MESSAGE = TextMessage(text="上一則回覆仍在處理中，請等待AI回應後再發送訊息。")
+WAIT_PUSH_TIMEOUT = 5  # 秒；回覆判斷結果前最多等待「請等待」推播送出的時間
+
+def is_invalid_answer(user_message):
+    """判斷回覆是否明顯無效，無效時直接回覆提示而不呼叫 DeepSeek"""
+    return not user_message or len(user_message) > MAX_ANSWER_LENGTH or ANSWER_NOISE_RE.fullmatch(user_message) is not None
+
+def finish_screening(event, user_id, state, score_all_final, today=None):
+    """篩檢結束：回覆結果與給語言治療師看的紀錄，並將使用者狀態重設為主選單"""
+    today = get_formatted_today(today)
+    right_questions = ", ".join(map(str, state.right_questions))  # 作答時已依題號排序插入
+    wrong_questions = ", ".join(map(str, state.wrong_questions))
+    response_text_1 = build_result_text(score_all_final, state.original_group)
+    response_text_2 = REPORT_TEMPLATE.format(
+        today=today,
+        total_months=state.total_months,
+        right_questions=right_questions,
+        wrong_questions=wrong_questions
+    )
+    reply_text(event, response_text_1, response_text_2)
+    user_states.pop(user_id, None)
+
+    if record_sheet is not None:
+        # 整列一次寫入（單次 API 呼叫），不逐格更新
+        row = [
+            today, user_id, state.total_months, state.original_group, score_all_final,
+            evaluate_development(score_all_final, state.original_group),
+            right_questions,
+            wrong_questions,
+        ]
+        future = RECORD_POOL.submit(record_sheet.append_rows, [row], value_input_option="RAW")
+        future.add_done_callback(log_background_error)
+
+def advance_group(state, direction):
+    """移至下一個（direction=1）或上一個（direction=-1）月齡組，記錄新組別的題號並回傳題目"""
+    state.group += direction
+    state.current_index = 0
+    state.scores["all_current"] = 0
+    questions = get_questions_for_group(state.group)
+    state.question_numbers = [question["題號"] for question in questions] if questions else []
+    return questions
+
+def abort_screening(event, user_id):
+    """找不到題目（試算表已更新）時結束篩檢並返回主選單"""
+    user_states.pop(user_id, None)
+    reply_text(event, MISSING_QUESTIONS_TEXT)
+
+def handle_testing(event, user_id, state, user_message, today=None):
+    """首組、順向、逆向施測共用的作答流程：判斷回應、計分，並在題組結束時換組或結束篩檢"""
+    # 明顯無效的回覆直接提示，不呼叫 DeepSeek
+    if is_invalid_answer(user_message):
+        send_reply(event, [INVALID_ANSWER_MESSAGE])
+        return
+
+    user_mode = state.mode
+    is_first_group = user_mode == MODE_TESTING_FIRST
+    question_numbers = state.question_numbers  # 進入題組時記錄的題號
+    current_index = state.current_index
+    current_group = state.group # 取得組別（載入題組時已記錄於狀態）
+    original_group = state.original_group
+
+    # **依題號取得目前這題的資料（組別、題號、題目、類別、提示、通過標準）；篩檢途中題目被刪除時結束篩檢
+    current_question = get_question(question_numbers[current_index]) if current_index < len(question_numbers) else None
+    if current_question is None:
+        logger.warning("第 %s 組找不到第 %d 題，題目可能已更新", current_group, current_index + 1)
+        abort_screening(event, user_id)
+        return
+    question_type = current_question["類別"]
+
+    # **先以規則與先前的判斷處理；需要讓 deepseek 根據題目、通過標準判斷時才請使用者等待
+    answer = normalize_answer(user_message)
+    judgement = cached_judgement(current_question, answer)
+    if judgement is None:
+        # 等待訊息與判斷同時送出；回覆前確認等待訊息已送達，避免排在下一題之後
+        wait_push = push_in_background(user_id, [WAIT_MESSAGE])
+        judgement = judge_answer(current_question, user_message, answer)
+        wait([wait_push], timeout=WAIT_PUSH_TIMEOUT)
+    deepseek_response, hint_response = judgement
+    logger.debug("現在題目：%s\n提示：%s\n通過標準：%s\n使用者回覆：%s\ndeepseek判斷：%s", current_question["題目"], current_question["提示"], current_question["通過標準"], user_message, deepseek_response)  # Debug記錄deepseek回應
+
+    # **根據 deepseek 回應處理邏輯
+    if deepseek_response.startswith("符合"):
+        scores = state.scores
+        scores["all_current"] += 1 # 當前題組的分數
+        scores["all"] += 1
+        if question_type != "E":
+            scores["r"] += 1
+        if question_type != "R":
+            scores["e"] += 1
+        bisect.insort(state.right_questions, current_question["題號"]) # 記錄對題題號（維持排序）
+    elif deepseek_response.startswith("不符合"):
+        bisect.insort(state.wrong_questions, current_question["題號"]) # 記錄錯題題號（維持排序）
+    elif deepseek_response.startswith("不清楚"):
+        # 若回答不清楚，提供簡單易懂的提示（判斷時已一併產生；由規則直接判斷時才另外呼叫）
+        if not hint_response:
+            hint_response = chat_with_deepseek(current_question["提示prompt"], **HINT_OPTIONS).strip()
+        retry_text = "請再次回應問題。" if is_first_group else "請再回覆一次。"
+        reply_text(event, f"{hint_response}\n{retry_text}")
+        return
+    else:
+        reply_text(event, "程式出現錯誤無法判斷回應，請聯絡負責人。" if is_first_group else "❌無法判斷回應，請再試一次。")
+        return
+
+    current_index += 1
+    state.current_index = current_index
+    logger.debug("第 %s 組第 %d 題，現在總分：%d，現在R分：%d，現在E分：%d", current_group, current_index, state.scores["all"], state.scores["r"], state.scores["e"])
+
+    if current_index < len(question_numbers):
+        next_question = get_question(question_numbers[current_index])
+        if next_question is None:
+            abort_screening(event, user_id)
+            return
+        user_states[user_id] = state  # 保存作答進度
+        reply_text(event, "了解，現在進入下一題。\n\n" + QUESTION_TEMPLATE.format_map({"question": next_question["題目"]}))
+        return
+
+    # **題組結束：全部通過往下一組（順向），未全部通過往上一組（逆向），到頭則結束篩檢
+    all_passed = state.scores["all_current"] == len(question_numbers)
+    direction = 0
+    if is_first_group:
+        if all_passed and current_group < 9:
+            logger.debug("進入順向施測模式")
+            state.mode = MODE_TESTING_FORWARD
+            state.scores["all"] = 0 # 首組分數已包含在累計分數中
+            direction = 1
+        elif not all_passed and current_group > 1:
+            logger.debug("進入逆向施測模式")
+            state.mode = MODE_TESTING_BACKWARD
+            direction = -1
+        if direction:
+            state.scores["r"] = 0
+            state.scores["e"] = 0
+        # 位於最後一個月齡組且全部通過，或位於第一個月齡組未全部通過：首組分數加上之前各組累計分數即為總分
+        final_group = current_group
+    elif user_mode == MODE_TESTING_FORWARD:
+        if all_passed and current_group < 9:
+            logger.debug("繼續順向")
+            direction = 1
+        # 總分=首組（含）之前所有組數的總分加上順向施測分數
+        final_group = original_group + 1
+    else:
+        if not all_passed and current_group > 1:
+            logger.debug("繼續逆向")
+            direction = -1
+        # 總分=當前組數減一所有組數的總分+逆向施測分數+首組分數（逆向到第一組時 CUM_ALL[0] 為 0）
+        final_group = current_group
+
+    if direction:
+        new_questions = advance_group(state, direction)
+        if new_questions:
+            user_states[user_id] = state
+            reply_text(event, QUESTION_TEMPLATE.format_map({"question": new_questions[0]["題目"]}))
+        else:
+            abort_screening(event, user_id)
+        return
+
+    score_all_final, _, _ = finalize_scores(final_group, state.scores["all"], state.scores["r"], state.scores["e"])
+    finish_screening(event, user_id, state, score_all_final, today)
+
+@handler.add(MessageEvent, message=TextMessageContent)
 def handle_message(event):
-    """處理使用者輸入的文字訊息"""
+    """處理使用者輸入的文字訊息；同一使用者一次只處理一則訊息，連續送出的回覆不會同時判斷、更新同一份狀態"""
+    if is_duplicate_event(event):
+        logger.info("略過重送的事件 %s", event.webhook_event_id)
+        return
+
     user_id = event.source.user_id  # 取得使用者 ID
+    with user_states.try_lock(user_id) as acquired:
+        # 上一則訊息仍在處理（例如等待 AI 判斷）時直接請使用者稍候，不佔用執行緒排隊等待
+        if not acquired:
+            send_reply(event, [BUSY_MESSAGE])
+            return
+        process_message(event, user_id)
+
+def process_message(event, user_id):
+    """依使用者目前模式處理訊息（呼叫時已取得該使用者的鎖）"""
     user_message = event.message.text.strip()  # 去除空格
+    today = datetime.now().date()  # 同一請求只取一次日期（計算月齡與篩檢紀錄共用）
 
-    # **檢查使用者狀態，預設為「主選單」
-    if user_id not in user_states:
-        user_states[user_id] = {"mode": MODE_MAIN_MENU}
+    # **檢查使用者狀態，沒有狀態即為「主選單」（主選單狀態不另外保存）
+    state = user_states.get(user_id) or MAIN_MENU_STATE
 
-    user_mode = user_states[user_id]["mode"]  # 取得使用者目前模式
+    user_mode = state.mode  # 取得使用者目前模式
 
     # **返回主選單
     if user_message == "返回":
-        user_states[user_id] = {"mode": MODE_MAIN_MENU}
+        user_states.pop(user_id, None)
         response_text = "已返回主選單。\n\n若想重新進行兒童語言篩檢，請輸入「篩檢」。"
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=response_text))
+        reply_text(event, response_text)
         return
 
     # **主選單模式
     if user_mode == MODE_MAIN_MENU:
         if user_message == "篩檢":
-            user_states[user_id] = {"mode": MODE_AGING}
+            user_states[user_id] = UserState(mode=MODE_AGING)
             response_text = "請提供孩子的西元出生年月日（格式：YYYY-MM-DD），以便開始語言篩檢。\n注意：需為西元出生年月日，且「-」必不可少。\n\n輸入「返回」回到主選單。"
         elif user_message == "提升":
-            user_states[user_id] = {"mode": MODE_TIPS}
+            user_states[user_id] = UserState(mode=MODE_TIPS)
             response_text = "提升語言能力功能待開發，若造成不便敬請見諒。\n\n輸入「返回」回到主選單。"
         elif user_message == "治療":
-            user_states[user_id] = {"mode": MODE_TREATMENT}
+            user_states[user_id] = UserState(mode=MODE_TREATMENT)
             response_text = "提供語言治療場所功能待開發，若造成不便敬請見諒。\n\n輸入「返回」回到主選單。"
         else:
             response_text = "無效指令。\n\n若想進行兒童語言篩檢，請輸入「篩檢」。"
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=response_text))
+        reply_text(event, response_text)
         return
 
     # **語言發展建議 & 治療模式
     if user_mode in [MODE_TIPS, MODE_TREATMENT]:
         if user_message == "返回":
-            user_states[user_id] = {"mode": MODE_MAIN_MENU}
+            user_states.pop(user_id, None)
             response_text = "已返回主選單。\n\n若想進行兒童語言篩檢，請輸入「篩檢」。"
         else:
             response_text = "輸入「返回」回到主選單。"
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=response_text))
+        reply_text(event, response_text)
         return
 
     # **篩檢模式（計算年齡）
     if user_mode == MODE_AGING:
-        print("計算月齡模式")
-        match = re.search(r"\b(\d{4})-(\d{2})-(\d{2})\b", user_message)
-        if match:
-            birth_date = datetime.strptime(match.group(0), "%Y-%m-%d").date()
-            total_months = calculate_age(str(birth_date))
+        logger.debug("計算月齡模式")
+        match = BIRTHDATE_RE.search(user_message)
+        birth_date = parse_birthdate(match) if match else None
+        if birth_date:
+            total_months = months_between(birth_date, today)
 
             if total_months > 36:
                 response_text = "本篩檢僅適用於三歲以下兒童，若您的孩子月齡超過36個月，建議聯絡語言治療師進行進一步評估。\n\n輸入「返回」回到主選單。"
-                user_states[user_id] = {"mode": MODE_MAIN_MENU}
+                user_states.pop(user_id, None)
             else:
                 questions = get_questions_by_age(total_months)
-                print("首組月齡組題目資訊為：", questions)
+                logger.debug("首組月齡組題目資訊為：%s", questions)
                 if questions:
                     group = questions[0]["組別"]  # 取得題目所屬的組別
-                    min_age_in_group = get_min_age_for_group(group)
-
-                    user_states[user_id] = {
-                        "mode": MODE_TESTING_FIRST,
-                        "total_months": total_months,
-                        "questions": questions,
-                        "current_index": 0,
-                        "score_all_current": 0,
-                        "score_all": 0, "score_r": 0, "score_e": 0,
-                        "original_group": group,
-                        "group": group,
-                        "min_age_in_group": min_age_in_group,
-                        "right_questions" : [],
-                        "wrong_questions" : []
-                    }
-                    print("進入首組篩檢模式")
-                    response_text_1 = f"""您的孩子目前 {total_months} 個月大，請詳閱以下篩檢注意事項。
-
-1.您可以使用「可以」、「不可以」回應，也能描述孩子狀況交由AI判斷。如：
-題目：「當您對孩子說『不行』時，他會停下來嗎？」
-回應示範：「他會看著我，但停不停下來要看他心情。」
-
-2.若您不確定題目意思時，請回覆「不清楚」，AI會提供說明。
 
-3.由於AI需要時間回應，請回答完後稍加等待並避免再次傳送訊息。
-
-4.請盡量完成所有題目，如需中斷請輸入「返回」。
-
-5.本測驗僅供參考，不代表正式診斷結果，如有疑慮請諮詢語言治療師。"""
-                    response_text_2 = f"現在開始篩檢，請回答以下題目。\n題目：{questions[0]['題目']}\n\n輸入「返回」可中途退出篩檢。"
-                    line_bot_api.reply_message(event.reply_token, [TextSendMessage(text=response_text_1), TextSendMessage(text=response_text_2)])
+                    user_states[user_id] = UserState(
+                        mode=MODE_TESTING_FIRST,
+                        total_months=total_months,
+                        original_group=group,
+                        group=group,
+                        question_numbers=[question["題號"] for question in questions],
+                        scores={"all": 0, "all_current": 0, "r": 0, "e": 0},
+                    )
+                    logger.debug("進入首組篩檢模式")
+                    response_text_1 = SCREENING_NOTICE_TEMPLATE.format_map({"total_months": total_months})
+                    response_text_2 = "現在開始篩檢，請回答以下題目。\n" + QUESTION_TEMPLATE.format_map({"question": questions[0]["題目"]})
+                    reply_text(event, response_text_1, response_text_2)
                     return
                 else:
                     response_text = "無法找到適合此年齡的篩檢題目，請確認 Google Sheets 設定是否正確。\n\n輸入「返回」回到主選單。"
-                    user_states[user_id] = {"mode": MODE_MAIN_MENU}
+                    user_states.pop(user_id, None)
         else:
             response_text = "請提供孩子的「西元」出生年月日（格式：YYYY-MM-DD），並且「-」不可省略，例如 2020-08-15。\n\n輸入「返回」回到主選單。"
 
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=response_text))
+        reply_text(event, response_text)
         return
 
-    # **首組篩檢
-    if user_mode == MODE_TESTING_FIRST:
-        state = user_states[user_id]
-        questions = state["questions"]
-        current_index = state["current_index"]
-        score_all_first = state["score_all"]
-        score_r_first = state["score_r"]
-        score_e_first = state["score_e"]
-        original_group = state["original_group"]
-        min_age_in_group = state["min_age_in_group"]  # 該組最小月齡
-        
-        # 回覆使用者收到訊息並等待
-        response_text_wait = "已收到回覆，請等待AI回應，等待過程中請勿再發送訊息。"
-        user_id = event.source.user_id  # 取得使用者 LINE ID
-        line_bot_api.push_message(user_id, TextSendMessage(text=response_text_wait))
-
-        # **取得目前這題的資料
-        current_question = questions[current_index] # 取得該題所有資料包含組別、題號、題目、類別、提示、通過標準
-        current_group = int(questions[0]["組別"]) # 取得組別
-        question_number = current_question["題號"] # 取得題號
-        question_type = current_question["類別"] # 取得類別
-        hint = current_question["提示"] # 取得提示
-        pass_criteria = current_question["通過標準"] # 取得通過標準
-
-        print("第", current_group, "組數量：", len(questions))###
-
-        # **讓 deepseek 根據題目、提示、通過標準來判斷使用者回應
-        deepseek_prompt = f"""
-        題目：{current_question["題目"]}
-        通過標準：{pass_criteria}
-        回應：{user_message}
-        根據題目、回應判斷回應是否符合「通過標準」：
-        1. 不清楚：回應表示對題目疑惑如不清楚，或回應仍不足以判斷符不符合。
-        2. 符合：回應符合「通過標準」(不需字句相同)或明確肯定。
-        3. 不符合：回應並非不清楚且未達「通過標準」或明確否定。
-        只回應「符合」、「不符合」或「不清楚」，勿額外解釋或加入符號。
-        """
-
-        deepseek_response = chat_with_deepseek(deepseek_prompt).strip()
-        print(f"現在題目：{current_question['題目']}\n提示：{hint}\n通過標準：{pass_criteria}\n使用者回覆：{user_message}\ndeepseek判斷：{deepseek_response}")  # Debug記錄deepseek回應
-
-        # **根據 deepseek 回應處理邏輯
-        if deepseek_response.startswith("符合"):
-            score_all_first += 1
-            user_states[user_id]["score_all"] = score_all_first
-            user_states[user_id]["right_questions"].append(question_number) # 記錄對題題號
-            current_index += 1
-            if question_type == "R":
-                score_r_first += 1
-                user_states[user_id]["score_r"] = score_r_first
-
-            elif question_type == "E":
-                score_e_first += 1
-                user_states[user_id]["score_e"] = score_e_first
-                
-            else:
-                score_r_first += 1
-                score_e_first += 1
-                user_states[user_id]["score_r"] = score_r_first
-                user_states[user_id]["score_e"] = score_e_first
-            response_text = "了解，現在進入下一題。\n\n"
-        elif deepseek_response.startswith("不符合"):
-            current_index += 1
-            user_states[user_id]["wrong_questions"].append(question_number) # 記錄錯題題號
-            response_text = "了解，現在進入下一題。\n\n"
-        elif deepseek_response.startswith("不清楚"):
-            # 若回答不清楚，提供簡單易懂的提示
-            hint_prompt = f"""
-            題目：{current_question['題目']}，例子：{hint}
-            使用者回應模糊或不理解題目需提示，請根據題目與例子生成30字內的簡單提示。
-            """
-            hint_response = chat_with_deepseek(hint_prompt).strip()
-            response_text = f"{hint_response}\n請再次回應問題。"
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=response_text))
-            return
-        else:
-            response_text = "程式出現錯誤無法判斷回應，請聯絡負責人。"
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=response_text))
-            return
-        print(f"首組第{current_index}題，現在總分：{score_all_first}，現在R分{score_r_first}，現在E分{score_e_first}")
-        user_states[user_id]["current_index"] = current_index
-
-        if current_index < len(questions):
-            response_text += f"題目：{questions[current_index]['題目']}\n\n輸入「返回」可中途退出篩檢。"
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=response_text))
-            return
-
-        else:
-            pass_percentage = score_all_first / len(questions)  # 計算通過比例
-
-            if pass_percentage == 1.0:
-                if current_group < 9:
-                    # 進入順向模式
-                    print("進入順向施測模式")
-                    user_states[user_id]["mode"] = MODE_TESTING_FORWARD
-                    user_states[user_id]["status"] = "Forward"
-                    user_states[user_id]["group"] = current_group + 1
-                    user_states[user_id]["min_age_in_group"] = get_min_age_for_group(current_group + 1)
-                    user_states[user_id]["questions"] = get_questions_by_age(get_min_age_for_group(current_group + 1))
-                    user_states[user_id]["current_index"] = 0
-                    user_states[user_id]["score_all"] = 0
-                    user_states[user_id]["score_r"] = 0
-                    user_states[user_id]["score_e"] = 0
-                    response_text = f"題目：{user_states[user_id]['questions'][0]['題目']}\n\n輸入「返回」可中途退出篩檢。"
-                    line_bot_api.reply_message(event.reply_token, TextSendMessage(text=response_text))
-                    return
-                else:
-                    # 位於最後一個月齡組
-                    score_all_final = score_all_first + 44 # 第1-8組分數加總為44，加上第9組分數即為總分。
-                    #score_r_final = score_r_first + 23 # 第1-8組R分數加總為23，加上第9組R分數即為總分。
-                    #score_e_final = score_e_first + 33 # 第1-8組E分數加總為33，加上第9組E分數即為總分。
-                    evaluate_result = evaluate_development(score_all_final, original_group)
-                    today = datetime.now().strftime("%Y-%m-%d")
-                    total_months = user_states[user_id]["total_months"]
-                    right_questions = user_states[user_id]["right_questions"]
-                    sorted_right_questions = sorted(right_questions, key=lambda x: int(x))
-                    wrong_questions = user_states[user_id]["wrong_questions"]
-                    sorted_wrong_questions = sorted(wrong_questions, key=lambda x: int(x))
-                    response_text_1 = f"""篩檢結束，總分為{score_all_final}分。
-評估結果為：{evaluate_result}。
-
-請記住，本測驗結果僅供參考，不代表真實診斷結果，若有疑慮請聯絡語言治療師。
-                    
-輸入「返回」回到主選單。"""
-                    response_text_2 = f"""若有需要請將此訊息給語言治療師看：
-本次篩檢時間為：{today}。
-該孩子於此篩檢時月齡為：{total_months}。
-正確題目為：{', '.join(map(str, sorted_right_questions))}。
-錯誤題目為：{', '.join(map(str, sorted_wrong_questions))}。
-                    """
-                    line_bot_api.reply_message(event.reply_token, [TextSendMessage(text=response_text_1), TextSendMessage(text=response_text_2)])
-                    user_states[user_id] = {"mode": MODE_MAIN_MENU}
-                    return
-
-            elif pass_percentage < 1.0:
-                if current_group > 1:
-                    # 進入逆向模式
-                    print("進入逆向施測模式")
-                    user_states[user_id]["mode"] = MODE_TESTING_BACKWARD
-                    user_states[user_id]["status"] = "Backward"
-                    user_states[user_id]["group"] = current_group - 1
-                    user_states[user_id]["min_age_in_group"] = get_min_age_for_group(current_group - 1)
-                    user_states[user_id]["questions"] = get_questions_by_age(get_min_age_for_group(current_group - 1))
-                    user_states[user_id]["current_index"] = 0
-                    user_states[user_id]["score_r"] = 0
-                    user_states[user_id]["score_e"] = 0
-                    response_text = f"題目：{user_states[user_id]['questions'][0]['題目']}\n\n輸入「返回」可中途退出篩檢。"
-                    line_bot_api.reply_message(event.reply_token, TextSendMessage(text=response_text))
-                    return
-                else:
-                    # 位於第一個月齡組
-                    score_all_final = score_all_first # 第1組分數即為總分。
-                    #score_r_final = score_r_first # 第1組R分數即為總分。
-                    #score_e_final = score_e_first # 第1組E分數即為總分。
-                    evaluate_result = evaluate_development(score_all_final, original_group)
-                    today = datetime.now().strftime("%Y-%m-%d")
-                    total_months = user_states[user_id]["total_months"]
-                    right_questions = user_states[user_id]["right_questions"]
-                    sorted_right_questions = sorted(right_questions, key=lambda x: int(x))
-                    wrong_questions = user_states[user_id]["wrong_questions"]
-                    sorted_wrong_questions = sorted(wrong_questions, key=lambda x: int(x))
-                    response_text_1 = f"""篩檢結束，總分為{score_all_final}分。
-評估結果為：{evaluate_result}。
-
-請記住，本測驗結果僅供參考，不代表真實診斷結果，若有疑慮請聯絡語言治療師。
-                    
-輸入「返回」回到主選單。"""
-                    response_text_2 = f"""若有需要請將此訊息給語言治療師看：
-本次篩檢時間為：{today}。
-該孩子於此篩檢時月齡為：{total_months}。
-正確題目為：{', '.join(map(str, sorted_right_questions))}。
-錯誤題目為：{', '.join(map(str, sorted_wrong_questions))}。
-                    """
-                    line_bot_api.reply_message(event.reply_token, [TextSendMessage(text=response_text_1), TextSendMessage(text=response_text_2)])
-                    user_states[user_id] = {"mode": MODE_MAIN_MENU}
-                    return
-                    
-
-    ## **順向篩檢
-    if user_mode == MODE_TESTING_FORWARD:
-        state = user_states[user_id]
-        questions = state["questions"]
-        current_index = state["current_index"]
-        score_all_forward_current = state["score_all_current"] # score_all_forward_current指當前題組的分數
-        score_all_forward_whole = state["score_all"] # score_all_forward_whole指逆向施測總分
-        score_r_forward = state["score_r"]
-        score_e_forward = state["score_e"]
-        original_group = state["original_group"]
-        min_age_in_group = state["min_age_in_group"]  # 該組最小月齡
-
-        # 回覆使用者收到訊息並等待
-        response_text_wait = "已收到回覆，請等待AI回應，等待過程中請勿再發送訊息。"
-        user_id = event.source.user_id  # 取得使用者 LINE ID
-        line_bot_api.push_message(user_id, TextSendMessage(text=response_text_wait))
-
-
-        # **取得目前這題的資料
-        current_question = questions[current_index] # 取得該題所有資料包含組別、題號、題目、類別、提示、通過標準
-        current_group = int(questions[0]['組別']) # 取得組別
-        question_number = current_question["題號"] # 取得題號
-        question_type = current_question["類別"] # 取得類別
-        hint = current_question["提示"] # 取得提示
-        pass_criteria = current_question["通過標準"] # 取得通過標準
-
-        print("第", current_group, "組數量：", len(questions))###
-
-        # **讓 deepseek 根據題目、提示、通過標準來判斷使用者回應
-        deepseek_prompt = f"""
-        題目：{current_question["題目"]}
-        通過標準：{pass_criteria}
-        回應：{user_message}
-        根據題目、回應判斷回應是否符合「通過標準」：
-        1. 不清楚：回應表示對題目疑惑如不清楚，或回應仍不足以判斷符不符合。
-        2. 符合：回應符合「通過標準」(不需字句相同)或明確肯定。
-        3. 不符合：回應並非不清楚且未達「通過標準」或明確否定。
-        只回應「符合」、「不符合」或「不清楚」，勿額外解釋或加入符號。
-        """
-
-        deepseek_response = chat_with_deepseek(deepseek_prompt).strip()
-        print(f"現在題目：{current_question['題目']}\n提示：{hint}\n通過標準：{pass_criteria}\n使用者回覆：{user_message}\ndeepseek判斷：{deepseek_response}")  # Debug記錄deepseek回應
-
-        # **根據 deepseek 回應處理邏輯
-        if deepseek_response.startswith("符合"):
-            score_all_forward_current += 1
-            score_all_forward_whole += 1
-            user_states[user_id]["score_all_current"] = score_all_forward_current
-            user_states[user_id]["score_all"] = score_all_forward_whole
-            user_states[user_id]["right_questions"].append(question_number) # 記錄對題題號
-            current_index += 1
-            if question_type == "R":
-                score_r_forward += 1
-                user_states[user_id]["score_r"] = score_r_forward
-
-            elif question_type == "E":
-                score_e_forward += 1
-                user_states[user_id]["score_e"] = score_e_forward
-                
-            else:
-                score_r_forward += 1
-                score_e_forward += 1
-                user_states[user_id]["score_r"] = score_r_forward
-                user_states[user_id]["score_e"] = score_e_forward
-            response_text = "了解，現在進入下一題。\n\n"
-        elif deepseek_response.startswith("不符合"):
-            current_index += 1
-            user_states[user_id]["wrong_questions"].append(question_number) # 記錄錯題題號
-            response_text = "了解，現在進入下一題。\n\n"
-        elif deepseek_response.startswith("不清楚"):
-            # **若回答不清楚，提供簡單易懂的提示
-            hint_prompt = f"""
-            題目：{current_question['題目']}，例子：{hint}
-            使用者回應模糊或不理解題目需提示，請根據題目與例子生成30字內的簡單提示。
-            """
-            hint_response = chat_with_deepseek(hint_prompt).strip()
-            response_text = f"{hint_response}\n請再回覆一次。"
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=response_text))
-            return
-        else:
-            response_text = "❌無法判斷回應，請再試一次。"
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=response_text))
-            return
-        print("第", current_group, "組第幾題：", current_index, "現在總分：", score_all_forward_whole, "現在R分：", score_r_forward, "現在E分：", score_e_forward)
-        user_states[user_id]["current_index"] = current_index
-
-        if current_index < len(questions):
-            response_text += f"題目：{questions[current_index]['題目']}\n\n輸入「返回」可中途退出篩檢。"
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=response_text))
-            return
-        else:
-            pass_percentage = score_all_forward_current / len(questions)  # 計算通過比例
-
-            if pass_percentage == 1.0 and current_group < 9:  
-                # 順向施測（進入下一組）
-                print("繼續順向")
-                next_group = current_group + 1
-                min_age_in_group = get_min_age_for_group(next_group)
-                new_questions = get_questions_by_age(min_age_in_group)
-
-                if new_questions:
-                    user_states[user_id].update({
-                        "group": next_group,
-                        "min_age_in_group": min_age_in_group,
-                        "questions": new_questions,
-                        "current_index": 0,
-                        "score_all_current":0,
-                        "score_all": score_all_forward_whole, "score_r": score_r_forward, "score_e": score_e_forward,
-                        "right_questions" :user_states[user_id]["right_questions"],
-                        "wrong_questions": user_states[user_id]["wrong_questions"]
-                    })
-                    response_text = f"題目：{new_questions[0]['題目']}\n\n輸入「返回」可中途退出篩檢。"
-                    line_bot_api.reply_message(event.reply_token, TextSendMessage(text=response_text))
-                    return
-                else:
-                    response_text = "找不到新題組，系統出現錯誤。返回主選單。"
-                    line_bot_api.reply_message(event.reply_token, TextSendMessage(text=response_text))
-                    user_states[user_id] = {"mode": MODE_MAIN_MENU}
-                    return
-
-            else:
-                score_all_final = get_group_all_score(original_group) + score_all_forward_whole # 總分=當前組數減一所有組數的總分加上當前組的分數
-                #score_r_final = get_group_r_score(original_group) + score_r_forward
-                #score_e_final = get_group_e_score(original_group) + score_e_forward
-                evaluate_result = evaluate_development(score_all_final, original_group)
-                today = datetime.now().strftime("%Y-%m-%d")
-                total_months = user_states[user_id]["total_months"]
-                right_questions = user_states[user_id]["right_questions"]
-                sorted_right_questions = sorted(right_questions, key=lambda x: int(x))
-                wrong_questions = user_states[user_id]["wrong_questions"]
-                sorted_wrong_questions = sorted(wrong_questions, key=lambda x: int(x))
-                response_text_1 = f"""篩檢結束，總分為{score_all_final}分。
-評估結果為：{evaluate_result}。
-
-請記住，本測驗結果僅供參考，不代表真實診斷結果，若有疑慮請聯絡語言治療師。
-                    
-輸入「返回」回到主選單。"""
-                response_text_2 = f"""若有需要請將此訊息給語言治療師看：
-本次篩檢時間為：{today}。
-該孩子於此篩檢時月齡為：{total_months}。
-正確題目為：{', '.join(map(str, sorted_right_questions))}。
-錯誤題目為：{', '.join(map(str, sorted_wrong_questions))}。
-                    """
-                line_bot_api.reply_message(event.reply_token, [TextSendMessage(text=response_text_1), TextSendMessage(text=response_text_2)])
-                user_states[user_id] = {"mode": MODE_MAIN_MENU}
-                return
-                
-
-    ##逆向篩檢     
-    if user_mode == MODE_TESTING_BACKWARD:
-        state = user_states[user_id]
-        questions = state["questions"]
-        current_index = state["current_index"]
-        score_all_backward_current = state["score_all_current"]
-        score_all_backward_whole = state["score_all"]
-        score_r_backward = state["score_r"]
-        score_e_backward = state["score_e"]
-        original_group = state["original_group"]
-        min_age_in_group = state["min_age_in_group"]  # 該組最小月齡
-
-        # 回覆使用者收到訊息並等待
-        response_text_wait = "已收到回覆，請等待AI回應，等待過程中請勿再發送訊息。"
-        user_id = event.source.user_id  # 取得使用者 LINE ID
-        line_bot_api.push_message(user_id, TextSendMessage(text=response_text_wait))
-
-        # **取得目前這題的資料
-        current_question = questions[current_index] # 取得該題所有資料包含組別、題號、題目、類別、提示、通過標準
-        current_group = int(questions[0]['組別']) # 取得組別
-        question_number = current_question["題號"] # 取得題號
-        question_type = current_question["類別"] # 取得類別
-        hint = current_question["提示"] # 取得提示
-        pass_criteria = current_question["通過標準"] # 取得通過標準
-
-        print("第", current_group, "組數量：", len(questions))###
-
-        # **讓 deepseek 根據題目、提示、通過標準來判斷使用者回應
-        deepseek_prompt = f"""
-        題目：{current_question["題目"]}
-        通過標準：{pass_criteria}
-        回應：{user_message}
-        根據題目、回應判斷回應是否符合「通過標準」：
-        1. 不清楚：回應表示對題目疑惑如不清楚，或回應仍不足以判斷符不符合。
-        2. 符合：回應符合「通過標準」(不需字句相同)或明確肯定。
-        3. 不符合：回應並非不清楚且未達「通過標準」或明確否定。
-        只回應「符合」、「不符合」或「不清楚」，勿額外解釋或加入符號。
-        """
-
-        deepseek_response = chat_with_deepseek(deepseek_prompt).strip()
-        print(f"現在題目：{current_question['題目']}\n提示：{hint}\n通過標準{pass_criteria}\n使用者回覆{user_message}\ndeepseek判斷：{deepseek_response}")  # Debug記錄deepseek回應
-
-        # **根據 deepseek 回應處理邏輯
-        if deepseek_response.startswith("符合"):
-            score_all_backward_current += 1
-            score_all_backward_whole += 1
-            user_states[user_id]["score_all_current"] = score_all_backward_current
-            user_states[user_id]["score_all"] = score_all_backward_whole
-            user_states[user_id]["right_questions"].append(question_number) # 記錄對題題號
-            current_index += 1
-            if question_type == "R":
-                score_r_backward += 1
-                user_states[user_id]["score_r"] = score_r_backward
-
-            elif question_type == "E":
-                score_e_backward += 1
-                user_states[user_id]["score_e"] = score_e_backward
-                
-            else:
-                score_r_backward += 1
-                score_e_backward += 1
-                user_states[user_id]["score_r"] = score_r_backward
-                user_states[user_id]["score_e"] = score_e_backward
-            response_text = "了解，現在進入下一題。\n\n"
-        elif deepseek_response.startswith("不符合"):
-            current_index += 1
-            user_states[user_id]["wrong_questions"].append(question_number) # 紀錄錯題題號
-            response_text = "了解，現在進入下一題。\n\n"
-        elif deepseek_response.startswith("不清楚"):
-            # **若回答不清楚，提供簡單易懂的提示
-            hint_prompt = f"""
-            題目：{current_question['題目']}，例子：{hint}
-            使用者回應模糊或不理解題目需提示，請根據題目與例子生成30字內的簡單提示。
-            """
-            hint_response = chat_with_deepseek(hint_prompt).strip()
-            response_text = f"{hint_response}\n請再回覆一次。"
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=response_text))
-            return
-        else:
-            response_text = "❌無法判斷回應，請再試一次。"
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=response_text))
-            return
-        print("第", current_group, "組第幾題：", current_index, "現在總分：", score_all_backward_whole, "現在R分：", score_r_backward, "現在E分：", score_e_backward)
-        user_states[user_id]["current_index"] = current_index
-
-        if current_index < len(questions):
-            response_text += f"題目：{questions[current_index]['題目']}\n\n輸入「返回」可中途退出篩檢。"
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=response_text))
-            return
-        else:
-            pass_percentage = score_all_backward_current / len(questions)  # 計算通過比例
-
-            if pass_percentage < 1.0 and current_group > 1:  
-                # 逆向施測（進入上一組）
-                print("繼續逆向")
-                next_group = current_group - 1
-                min_age_in_group = get_min_age_for_group(next_group)
-                new_questions = get_questions_by_age(min_age_in_group)
-
-                if new_questions:
-                    user_states[user_id].update({
-                        "group": next_group,
-                        "min_age_in_group": min_age_in_group,
-                        "questions": new_questions,
-                        "current_index": 0,
-                        "score_all_current": 0,
-                        "score_all": score_all_backward_whole, "score_r": score_r_backward, "score_e": score_e_backward,
-                        "right_questions" :user_states[user_id]["right_questions"],
-                        "wrong_questions": user_states[user_id]["wrong_questions"]
-                    })
-                    response_text = f"題目：{new_questions[0]['題目']}\n\n輸入「返回」可中途退出篩檢。"
-                    line_bot_api.reply_message(event.reply_token, TextSendMessage(text=response_text))
-                    return
-                
-                else:
-                    response_text = "找不到新題組，系統出現錯誤。返回主選單。"
-                    user_states[user_id] = {"mode": MODE_MAIN_MENU}
-                    line_bot_api.reply_message(event.reply_token, TextSendMessage(text=response_text))
-                    return
-
-            else:
-                if current_group > 1: # 確保如果逆向到第一組current_group - 1不會等於零
-                    score_all_final = get_group_all_score(current_group - 1) + score_all_backward_whole # 總分=當前組數減一所有組數的總分+逆向施測分數+首組分數
-                    #score_r_final = get_group_r_score(current_group - 1) + score_r_backward
-                    #score_e_final = get_group_e_score(current_group - 1) + score_e_backward
-                    evaluate_result = evaluate_development(score_all_final, original_group)
-                    today = datetime.now().strftime("%Y-%m-%d")
-                    total_months = user_states[user_id]["total_months"]
-                    right_questions = user_states[user_id]["right_questions"]
-                    sorted_right_questions = sorted(right_questions, key=lambda x: int(x))
-                    wrong_questions = user_states[user_id]["wrong_questions"]
-                    sorted_wrong_questions = sorted(wrong_questions, key=lambda x: int(x))
-                    response_text_1 = f"""篩檢結束，總分為{score_all_final}分。
-評估結果為：{evaluate_result}。
-
-請記住，本測驗結果僅供參考，不代表真實診斷結果，若有疑慮請聯絡語言治療師。
-                    
-輸入「返回」回到主選單。"""
-                    response_text_2 = f"""若有需要請將此訊息給語言治療師看：
-本次篩檢時間為：{today}。
-該孩子於此篩檢時月齡為：{total_months}。
-正確題目為：{', '.join(map(str, sorted_right_questions))}。
-錯誤題目為：{', '.join(map(str, sorted_wrong_questions))}。
-                    """
-                    line_bot_api.reply_message(event.reply_token, [TextSendMessage(text=response_text_1), TextSendMessage(text=response_text_2)])
-                    user_states[user_id] = {"mode": MODE_MAIN_MENU}
-                    return
-
-                else: # 如果逆向到第一組則逆向施測分數加上首組分數等於總分
-                    score_all_final = score_all_backward_whole
-                    #score_r_final = score_r_backward
-                    #score_e_final = score_e_backward
-                    evaluate_result = evaluate_development(score_all_final, original_group)
-                    today = datetime.now().strftime("%Y-%m-%d")
-                    total_months = user_states[user_id]["total_months"]
-                    right_questions = user_states[user_id]["right_questions"]
-                    sorted_right_questions = sorted(right_questions, key=lambda x: int(x))
-                    wrong_questions = user_states[user_id]["wrong_questions"]
-                    sorted_wrong_questions = sorted(wrong_questions, key=lambda x: int(x))
-                    response_text_1 = f"""篩檢結束，總分為{score_all_final}分。
-評估結果為：{evaluate_result}。
-
-請記住，本測驗結果僅供參考，不代表真實診斷結果，若有疑慮請聯絡語言治療師。
-                    
-輸入「返回」回到主選單。"""
-                    response_text_2 = f"""若有需要請將此訊息給語言治療師看：
-本次篩檢時間為：{today}。
-該孩子於此篩檢時月齡為：{total_months}。
-正確題目為：{', '.join(map(str, sorted_right_questions))}。
-錯誤題目為：{', '.join(map(str, sorted_wrong_questions))}。
-                    """
-                    line_bot_api.reply_message(event.reply_token, [TextSendMessage(text=response_text_1), TextSendMessage(text=response_text_2)])
-                    user_states[user_id] = {"mode": MODE_MAIN_MENU}
-                    return
+    # **篩檢作答（首組、順向、逆向）
+    if user_mode in TESTING_MODES:
+        handle_testing(event, user_id, state, user_message, today)
+        return
 
-# **啟動 Flask 應用**
+# **啟動 Flask 應用（僅供本機開發；正式環境請以 Procfile 中的 gunicorn + gevent 啟動）**
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000)
\ No newline at end of file
+    app.run(host="0.0.0.0", port=5000, threaded=True, use_reloader=False, debug=False)
\ No newline at end of file
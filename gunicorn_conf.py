@@ -0,0 +1,11 @@
+# **gunicorn 設定（Procfile 以 gunicorn -c gunicorn_conf.py app:app 啟動）**
+# Webhook 處理主要在等待 DeepSeek 與 LINE API 回應，使用 gevent worker 讓同一個 worker 可同時處理多個請求；
+# gevent worker 會在載入 app 前自動 monkey patch，app.py 不需另外呼叫 monkey.patch_all()
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+worker_class = "gevent"
+# 使用者狀態未設定 REDIS_URL 時保存在行程記憶體中，worker 數量需維持為 1
+workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+worker_connections = 1000  # 每個 worker 同時處理的連線數
+keepalive = 5  # 秒；保留與前端代理的連線，減少重新建立連線
@@ -0,0 +1,39 @@
+# **篩檢計分函式（純計算、不含 I/O，可用 mypyc 編譯：mypyc scoring.py）**
+from bisect import bisect_right
+from functools import lru_cache
+from typing import Final, Tuple
+
+# 各組別的百分等級切分點（索引為組別減一）
+DEVELOPMENT_STANDARDS: Final[Tuple[Tuple[int, int, int, int, int], ...]] = (
+    (2, 4, 7, 8, 9),  # 第1組
+    (8, 9, 9, 11, 13),  # 第2組
+    (11, 13, 14, 18, 19),  # 第3組
+    (17, 19, 21, 25, 28),  # 第4組
+    (22, 24, 25, 33, 38),  # 第5組
+    (25, 30, 31, 42, 45),  # 第6組
+    (33, 36, 44, 48, 50),  # 第7組
+    (37, 43, 48, 50, 50),  # 第8組
+    (44, 48, 50, 50, 50)  # 第9組
+)
+
+# **各組別與其之前組別的累計總分（以組別為索引，索引 0 代表第 1 組之前沒有分數）
+CUM_ALL: Final[Tuple[int, ...]] = (0, 5, 10, 15, 20, 26, 32, 38, 44, 50)  # 總分
+CUM_R: Final[Tuple[int, ...]] = (0, 3, 6, 9, 12, 16, 18, 21, 23, 24)  # R總分
+CUM_E: Final[Tuple[int, ...]] = (0, 2, 5, 9, 13, 16, 21, 27, 33, 39)  # E總分
+
+# 評估結果依序對應 <5%、5-25%、25-75%、75-90%、>90%
+DEVELOPMENT_LABELS: Final[Tuple[str, ...]] = ("疑似遲緩", "可能落後", "平均水準", "稍微超前", "超前")
+
+# 各組別判斷用的切分點（5%、25%、75%、90%；第三欄 50% 不影響結果），已排序可直接二分搜尋
+DEVELOPMENT_CUTOFFS: Final[Tuple[Tuple[int, ...], ...]] = tuple(
+    (standard[0], standard[1], standard[3], standard[4]) for standard in DEVELOPMENT_STANDARDS
+)
+
+#  根據組別與總分判斷結果（總分不小於幾個切分點即對應第幾個評估結果）
+@lru_cache(maxsize=4096)
+def evaluate_development(score_all_final: int, original_group: int) -> str:
+    return DEVELOPMENT_LABELS[bisect_right(DEVELOPMENT_CUTOFFS[original_group - 1], score_all_final)]
+
+def finalize_scores(group: int, score_all: int, score_r: int, score_e: int) -> Tuple[int, int, int]: # 加上 group 之前所有組別的累計分數，回傳 (總分, R總分, E總分)
+    previous = group - 1
+    return CUM_ALL[previous] + score_all, CUM_R[previous] + score_r, CUM_E[previous] + score_e